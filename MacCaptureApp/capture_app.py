@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 """Minimal macOS ScreenCaptureKit sample written in Python.
 
-This script starts an AppKit run loop, records the main display + system audio
-for a short duration, and writes a .mov file to ~/Movies.
+This script runs a CoreFoundation run loop (no AppKit), records the main display + system audio
+until -t/--time seconds pass (default 3600) or ESC is pressed, and writes a .mov file
+to captured_videos/ in the project root.
 
 Requirements:
   * macOS 13+
@@ -10,17 +11,31 @@ Requirements:
 """
 
 import argparse
-import datetime
+import collections
+import logging
+import logging.handlers
 import pathlib
+import queue
 import signal
 import os
 import sys
 import threading
+import time
 import tty
 import termios
 
-from Cocoa import NSApp, NSApplication, NSObject, NSTimer
-from Foundation import NSURL
+from Foundation import NSObject, NSURL
+from CoreFoundation import (
+    CFFileDescriptorCreate,
+    CFFileDescriptorCreateRunLoopSource,
+    CFFileDescriptorEnableCallBacks,
+    CFRunLoopAddSource,
+    CFRunLoopGetMain,
+    CFRunLoopRun,
+    CFRunLoopStop,
+    kCFFileDescriptorReadCallBack,
+    kCFRunLoopCommonModes,
+)
 from AVFoundation import (
     AVAssetWriter,
     AVAssetWriterInput,
@@ -31,52 +46,133 @@ from AVFoundation import (
     AVMediaTypeVideo,
     AVNumberOfChannelsKey,
     AVSampleRateKey,
+    AVVideoAllowFrameReorderingKey,
+    AVVideoAverageBitRateKey,
     AVVideoCodecKey,
-    AVVideoCodecTypeH264,
+    AVVideoCodecTypeHEVC,
+    AVVideoCompressionPropertiesKey,
+    AVVideoEncoderSpecificationKey,
+    AVVideoExpectedSourceFrameRateKey,
     AVVideoHeightKey,
+    AVVideoMaxKeyFrameIntervalKey,
+    AVVideoProfileLevelKey,
     AVVideoWidthKey,
 )
+from CoreAudio import kAudioFormatMPEG4AAC
+from VideoToolbox import kVTVideoEncoderSpecification_EnableHardwareAcceleratedVideoEncoder
 import ScreenCaptureKit as SCK
 import CoreMedia
+from CoreMedia import (
+    CMSampleBufferDataIsReady,
+    CMSampleBufferGetImageBuffer,
+    CMSampleBufferGetNumSamples,
+    CMSampleBufferGetPresentationTimeStamp,
+    CMSampleBufferGetSampleAttachmentsArray,
+)
 import Quartz as CoreVideo
 import objc
-from dispatch import dispatch_queue_create, DISPATCH_QUEUE_SERIAL, dispatch_after, dispatch_time, DISPATCH_TIME_NOW, dispatch_get_main_queue, dispatch_async
+from dispatch import DISPATCH_QUEUE_SERIAL, dispatch_after, dispatch_time, DISPATCH_TIME_NOW, dispatch_get_main_queue, dispatch_async
+from dispatch import dispatch_group_create, dispatch_group_enter, dispatch_group_leave, dispatch_group_notify
+from dispatch import dispatch_queue_create_with_target, dispatch_get_global_queue, QOS_CLASS_USER_INTERACTIVE, QOS_CLASS_USER_INITIATED
+
+
+# The main queue never changes; resolve it once instead of per dispatch call
+_MAIN_Q = dispatch_get_main_queue()
+
+logger = logging.getLogger("mac_capture")
+
+# Output directory, resolved and created once at import
+_CAPTURE_DIR = pathlib.Path(__file__).resolve().parent.parent / "captured_videos"
+_CAPTURE_DIR.mkdir(parents=True, exist_ok=True)
+
+# Global capture manager reference for signal handling
+_global_manager = None
+# Background listener draining queued log records (see setup_logging)
+_log_listener = None
+# Keep the stdin CFFileDescriptor alive while the run loop is watching it
+_keyboard_fd_ref = None
+_original_tty_settings = None
+
+
+def _emit(msg, fd=1):
+    """Write msg straight to fd with write(2), bypassing Python's text IO stack"""
+    data = msg.encode("utf-8")
+    while data:
+        try:
+            written = os.write(fd, data)
+        except InterruptedError:
+            continue
+        data = data[written:]
+
+
+class _StderrHandler(logging.Handler):
+    """Write records straight to fd 2, bypassing the buffered text stream"""
+
+    def emit(self, record):
+        try:
+            _emit(self.format(record) + "\n", fd=2)
+        except Exception:
+            self.handleError(record)
+
+
+def setup_logging():
+    """Queue log records so capture/main queue callers only pay for an enqueue"""
+    global _log_listener
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    _log_listener = logging.handlers.QueueListener(log_queue, _StderrHandler())
+    _log_listener.start()
+
+
+def shutdown_logging():
+    """Flush queued log records and stop the listener thread"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
 
 
-# Global delegate reference for signal handling
-_global_delegate = None
-_keyboard_monitor_stop = threading.Event()
+def terminate():
+    """Stop the main run loop; main() then restores the terminal and flushes logs"""
+    # Hop to the main queue so the stop lands inside CFRunLoopRun even if called early
+    dispatch_async(_MAIN_Q, lambda: CFRunLoopStop(CFRunLoopGetMain()))
 
 
 def trigger_interrupt():
     """Trigger interrupt handling (called by signal handler or keyboard monitor)"""
-    global _global_delegate
-    # Print immediately without buffering
-    sys.stdout.write("\n\n*** Keyboard interrupt detected ***\n")
-    sys.stdout.flush()
+    logger.info("\n*** Keyboard interrupt detected ***")
 
-    if _global_delegate and _global_delegate.manager:
+    if _global_manager is not None:
         # Set stop_reason but NOT is_stopping yet - stopCapture needs to run the stream stop logic
-        _global_delegate.manager.stop_reason = "interrupt"
+        _global_manager.stop_reason = "interrupt"
 
         # Try to stop gracefully
         def do_stop():
-            sys.stdout.write("Stopping capture...\n")
-            sys.stdout.flush()
-            _global_delegate.manager.stopCapture()
+            logger.info("Stopping capture...")
+            _global_manager.stopCapture()
 
-        dispatch_async(dispatch_get_main_queue(), do_stop)
+        dispatch_async(_MAIN_Q, do_stop)
 
         # Failsafe: if not stopped in 2 seconds, force exit
-        def force_exit():
-            sys.stdout.write("\nForce exiting...\n")
-            sys.stdout.flush()
-            # Use sys.exit() instead of os._exit() to allow proper cleanup and file flushing
-            sys.exit(0)
+        def force_exit(allow_grace=True):
+            # The writer is finalizing; cutting it short would leave an unplayable file,
+            # so give it longer, but still exit if finishWriting stalls
+            if allow_grace and _global_manager.is_finishing:
+                dispatch_after(
+                    dispatch_time(DISPATCH_TIME_NOW, 20_000_000_000),  # 20 seconds
+                    _MAIN_Q,
+                    lambda: force_exit(allow_grace=False)
+                )
+                return
+            logger.info("Force exiting...")
+            # Stop the run loop so main() still restores the terminal and flushes logs
+            terminate()
 
         dispatch_after(
             dispatch_time(DISPATCH_TIME_NOW, 2_000_000_000),  # 2 seconds
-            dispatch_get_main_queue(),
+            _MAIN_Q,
             force_exit
         )
 
@@ -86,39 +182,142 @@ def handle_sigint(signum, frame):
     trigger_interrupt()
 
 
-def keyboard_monitor():
-    """Monitor keyboard input in a separate thread for ESC key"""
-    original_settings = None
+def _keyboard_callback(fd_ref, callback_types, info):
+    """Read one key from stdin when the run loop reports it readable"""
     try:
-        # Save original terminal settings
-        original_settings = termios.tcgetattr(sys.stdin)
-        # Set terminal to cbreak mode (unbuffered, but preserve line discipline)
-        tty.setcbreak(sys.stdin.fileno())
-        # Disable echo
-        new_settings = termios.tcgetattr(sys.stdin)
-        new_settings[3] = new_settings[3] & ~termios.ECHO
-        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, new_settings)
-
-        while not _keyboard_monitor_stop.is_set():
-            ch = sys.stdin.read(1)
-            # ESC key is ASCII 27 (0x1b)
-            if ch == '\x1b':
-                trigger_interrupt()
-                break
-    except KeyboardInterrupt:
+        ch = os.read(sys.stdin.fileno(), 1)
+    except OSError:
+        return
+    # ESC key is ASCII 27 (0x1b)
+    if ch == b'\x1b':
         trigger_interrupt()
-    except:
+        return
+    if ch:
+        # CFFileDescriptor callbacks are one-shot; re-arm for the next key (not on EOF)
+        CFFileDescriptorEnableCallBacks(fd_ref, kCFFileDescriptorReadCallBack)
+
+
+def install_keyboard_monitor():
+    """Watch stdin for the ESC key from the main run loop (no extra thread)"""
+    global _keyboard_fd_ref, _original_tty_settings
+    fd = sys.stdin.fileno()
+    if not os.isatty(fd):
+        return
+
+    # Save original terminal settings
+    _original_tty_settings = termios.tcgetattr(fd)
+    # Set terminal to cbreak mode (unbuffered, but preserve line discipline)
+    tty.setcbreak(fd)
+    # Disable echo
+    new_settings = termios.tcgetattr(fd)
+    new_settings[3] = new_settings[3] & ~termios.ECHO
+    termios.tcsetattr(fd, termios.TCSADRAIN, new_settings)
+
+    fd_ref = CFFileDescriptorCreate(None, fd, False, _keyboard_callback, None)
+    CFFileDescriptorEnableCallBacks(fd_ref, kCFFileDescriptorReadCallBack)
+    source = CFFileDescriptorCreateRunLoopSource(None, fd_ref, 0)
+    CFRunLoopAddSource(CFRunLoopGetMain(), source, kCFRunLoopCommonModes)
+    _keyboard_fd_ref = fd_ref
+
+
+def restore_terminal():
+    """Restore the terminal settings changed by install_keyboard_monitor"""
+    if _original_tty_settings is None:
+        return
+    try:
+        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, _original_tty_settings)
+    except termios.error:
         pass
-    finally:
-        # Restore original terminal settings
-        if original_settings is not None:
-            try:
-                termios.tcsetattr(sys.stdin, termios.TCSADRAIN, original_settings)
-            except:
-                pass
 
 
-class CaptureManager(NSObject):
+def _resolve_filter_factory():
+    """Pick the SCContentFilter constructor available on this macOS once, at import"""
+    cls = SCK.SCContentFilter
+    if hasattr(cls, "filterWithDisplay_excludingWindows_exceptingApplications_"):
+        return lambda display: cls.filterWithDisplay_excludingWindows_exceptingApplications_(
+            display, [], []
+        )
+    if hasattr(cls, "filterWithDisplay_excludingWindows_"):
+        return lambda display: cls.filterWithDisplay_excludingWindows_(display, [])
+
+    instance = cls.alloc()
+    if hasattr(instance, "initWithDisplay_excludingWindows_exceptingApplications_"):
+        return lambda display: cls.alloc().initWithDisplay_excludingWindows_exceptingApplications_(
+            display, [], []
+        )
+    if hasattr(instance, "initWithDisplay_excludingWindows_"):
+        return lambda display: cls.alloc().initWithDisplay_excludingWindows_(display, [])
+    return lambda display: None
+
+
+_FILTER_FACTORY = _resolve_filter_factory()
+
+# ScreenCaptureKit constants compared on every sample, resolved once
+_OUTPUT_TYPE_SCREEN = int(SCK.SCStreamOutputTypeScreen)
+_OUTPUT_TYPE_AUDIO = int(SCK.SCStreamOutputTypeAudio)
+_FRAME_INFO_STATUS = SCK.SCStreamFrameInfoStatus
+_FRAME_STATUS_COMPLETE = SCK.SCFrameStatusComplete
+
+# Capture frame rate, plus the reduced rate used while the encoder is behind.
+# The CMTime intervals are built once instead of on every configuration change.
+_FRAME_RATE = 30
+_THROTTLED_FRAME_RATE = 20
+_FRAME_INTERVAL = CoreMedia.CMTimeMake(1, _FRAME_RATE)
+_THROTTLED_FRAME_INTERVAL = CoreMedia.CMTimeMake(1, _THROTTLED_FRAME_RATE)
+
+# Samples waiting for the writer to append them. When a ring is full the oldest
+# entry is dropped, so the encoder always gets the freshest frames. Keep the
+# video ring well below queueDepth: every queued frame pins a capture surface.
+_VIDEO_RING_FRAMES = 2
+_AUDIO_RING_SAMPLES = 100  # ~1-2 s of ScreenCaptureKit audio buffers
+# A drain that leaves entries behind (input not ready) retries after this delay,
+# since a static screen may push nothing new to wake it. At shutdown the rings
+# get this long to empty before the inputs are marked finished.
+_DRAIN_RETRY_NS = 5_000_000  # 5 ms
+_FINISH_DRAIN_TIMEOUT = 1.0  # seconds
+
+# Encoder backpressure policy: after this many consecutive frames dropped from
+# a full video ring, with no room in it for longer than the window, drop to the
+# throttled frame rate; go back to full rate after a run of frames that queue cleanly.
+_BACKPRESSURE_DROPS = 3
+_BACKPRESSURE_WINDOW = 0.033  # seconds (~one frame at 30 fps)
+_BACKPRESSURE_RECOVERY_FRAMES = 60
+
+# Writer settings that do not depend on the capture, built once. _setup_writer
+# merges them into fresh dicts with the per-capture size/rate entries.
+_BASE_VIDEO_SETTINGS = {
+    AVVideoCodecKey: AVVideoCodecTypeHEVC,
+    # Ask VideoToolbox for the hardware encoder behind the writer
+    AVVideoEncoderSpecificationKey: {
+        kVTVideoEncoderSpecification_EnableHardwareAcceleratedVideoEncoder: True,
+    },
+}
+_BASE_COMPRESSION_PROPERTIES = {
+    AVVideoExpectedSourceFrameRateKey: _FRAME_RATE,
+    # A keyframe every 2 s of capture, so rate control is not guessing the GOP
+    AVVideoMaxKeyFrameIntervalKey: _FRAME_RATE * 2,
+    AVVideoProfileLevelKey: "HEVC_Main_AutoLevel",
+    # No B-frames: lower encoder latency for real-time capture
+    AVVideoAllowFrameReorderingKey: False,
+}
+_BASE_ADAPTOR_ATTRS = {
+    CoreVideo.kCVPixelBufferPixelFormatTypeKey: CoreVideo.kCVPixelFormatType_420YpCbCr8BiPlanarVideoRange,
+    # IOSurface-backed like ScreenCaptureKit's buffers, so surfaces pass by reference
+    CoreVideo.kCVPixelBufferIOSurfacePropertiesKey: {},
+    CoreVideo.kCVPixelBufferMetalCompatibilityKey: True,
+}
+_BASE_AUDIO_SETTINGS = {
+    AVFormatIDKey: kAudioFormatMPEG4AAC,
+    AVEncoderBitRateKey: 128_000,
+}
+
+
+class CaptureManager(
+    NSObject,
+    # Declared conformance pins the callback selectors' Objective-C signatures
+    # (stream:didOutputSampleBuffer:ofType: takes a CMSampleBufferRef and an NSInteger)
+    protocols=[objc.protocolNamed("SCStreamOutput"), objc.protocolNamed("SCStreamDelegate")],
+):
     def init(self):
         self = objc.super(CaptureManager, self).init()
         if self is None:
@@ -128,52 +327,100 @@ class CaptureManager(NSObject):
         self.video_input = None
         self.audio_input = None
         self.pixel_adaptor = None
+        # Bound selectors resolved once in _setup_writer for the hot path
+        self._append_pb = None
+        self._ready_v = None
+        self._append_audio = None
+        self._ready_a = None
+        # Bounded rings drained onto the writer inputs (see _setup_writer)
+        self._video_frame_ring = collections.deque(maxlen=_VIDEO_RING_FRAMES)
+        self._audio_sample_ring = collections.deque(maxlen=_AUDIO_RING_SAMPLES)
+        self._drain_video = None
+        self._drain_audio = None
+        # Everything the sample callback needs, packed so it costs one attribute load
+        self._fast = None
         self.session_start_time = None
+        self.configuration = None
+        # Backpressure tracking, only touched on video_queue
+        self._last_ready_time = None
+        self._drops = 0
+        self._ready_streak = 0
+        self._throttled = False
         self.stop_reason = None  # "interrupt" or "time"
         self.is_stopping = False  # Prevent multiple stop calls
+        self.is_finishing = False  # Set once the writer is being finalized
         self.selected_display_index = 0  # Default to first display
-        self.capture_queue = dispatch_queue_create(
-            b"com.example.maccapture.capture", DISPATCH_QUEUE_SERIAL
+        # One sample handler queue per output type so audio bursts never queue
+        # behind video frames; video runs at the highest QoS
+        video_qos = dispatch_get_global_queue(QOS_CLASS_USER_INTERACTIVE, 0)
+        audio_qos = dispatch_get_global_queue(QOS_CLASS_USER_INITIATED, 0)
+        self.video_queue = dispatch_queue_create_with_target(
+            b"com.example.maccapture.capture.video", DISPATCH_QUEUE_SERIAL, video_qos
+        )
+        self.audio_queue = dispatch_queue_create_with_target(
+            b"com.example.maccapture.capture.audio", DISPATCH_QUEUE_SERIAL, audio_qos
+        )
+        # Appends run on their own queues so encoder/disk backpressure on one
+        # track never stalls the other or the ScreenCaptureKit handler queues
+        self.video_write_queue = dispatch_queue_create_with_target(
+            b"com.example.maccapture.write.video", DISPATCH_QUEUE_SERIAL, video_qos
         )
+        self.audio_write_queue = dispatch_queue_create_with_target(
+            b"com.example.maccapture.write.audio", DISPATCH_QUEUE_SERIAL, audio_qos
+        )
+        # Video and audio samples arrive concurrently; only one may start the writer session
+        self._session_lock = threading.Lock()
+        # Tracks outstanding shutdown work (stream stop, pending appends, finishWriting)
+        self._shutdown_group = dispatch_group_create()
+        # Ready before SCShareableContent returns, keeping path work out of the handler
+        self._cached_output_url = self._make_output_url()
         return self
 
     def startCapture(self):
         def handler(content, error):
             if error is not None:
-                print(f"Failed to get shareable content: {error}")
-                NSApp.terminate_(None)
+                logger.error(f"Failed to get shareable content: {error}")
+                terminate()
                 return
 
             displays = content.displays()
             if not displays:
-                print("No displays available")
-                NSApp.terminate_(None)
+                logger.error("No displays available")
+                terminate()
                 return
 
             if self.selected_display_index >= len(displays):
-                print(f"Error: Display {self.selected_display_index} not found. Available displays: {len(displays)}")
-                NSApp.terminate_(None)
+                logger.error(f"Error: Display {self.selected_display_index} not found. Available displays: {len(displays)}")
+                terminate()
                 return
 
             display = displays[self.selected_display_index]
-            print(f"Using display {self.selected_display_index}: {self._get_display_info(display)}")
+            logger.info(f"Using display {self.selected_display_index}: {self._get_display_info(display)}")
             filter = self._make_filter(display)
             if filter is None:
-                print("Failed to build content filter for display")
-                NSApp.terminate_(None)
+                logger.error("Failed to build content filter for display")
+                terminate()
                 return
             configuration = SCK.SCStreamConfiguration.alloc().init()
             configuration.setWidth_(1920)
             configuration.setHeight_(1080)
+            # Video-range NV12 ('420v') is what the HEVC encoder consumes and emits
+            # natively (1.5 bytes/pixel vs 4 for BGRA), so no conversion happens in between
+            configuration.setPixelFormat_(CoreVideo.kCVPixelFormatType_420YpCbCr8BiPlanarVideoRange)
             configuration.setCapturesAudio_(True)
             configuration.setSampleRate_(48_000)
             configuration.setChannelCount_(2)
-            configuration.setMinimumFrameInterval_(CoreMedia.CMTimeMake(1, 30))
+            configuration.setMinimumFrameInterval_(_FRAME_INTERVAL)
+            # Kept at 5 rather than 3: the video ring and the encoder also hold capture
+            # surfaces, so a shallower queue would make ScreenCaptureKit drop frames.
+            # Revisit if the output grows past 1080p, since each surface is resident memory.
             configuration.setQueueDepth_(5)
 
-            output_url = self._make_output_url()
+            self.configuration = configuration
+
+            output_url = self._cached_output_url
             if not self._setup_writer(output_url, configuration):
-                NSApp.terminate_(None)
+                terminate()
                 return
 
             self.stream = SCK.SCStream.alloc().initWithFilter_configuration_delegate_(
@@ -181,31 +428,31 @@ class CaptureManager(NSObject):
             )
 
             screen_added, screen_error = self.stream.addStreamOutput_type_sampleHandlerQueue_error_(
-                self, SCK.SCStreamOutputTypeScreen, self.capture_queue, None
+                self, SCK.SCStreamOutputTypeScreen, self.video_queue, None
             )
             if not screen_added:
-                print(f"Failed to add screen output: {screen_error}")
-                NSApp.terminate_(None)
+                logger.error(f"Failed to add screen output: {screen_error}")
+                terminate()
                 return
 
             audio_added, audio_error = self.stream.addStreamOutput_type_sampleHandlerQueue_error_(
-                self, SCK.SCStreamOutputTypeAudio, self.capture_queue, None
+                self, SCK.SCStreamOutputTypeAudio, self.audio_queue, None
             )
             if not audio_added:
-                print(f"Failed to add audio output: {audio_error}")
-                NSApp.terminate_(None)
+                logger.error(f"Failed to add audio output: {audio_error}")
+                terminate()
                 return
 
             def start_handler(error):
                 if error is not None:
-                    print(f"Failed to start capture: {error}")
-                    NSApp.terminate_(None)
+                    logger.error(f"Failed to start capture: {error}")
+                    terminate()
                 else:
-                    print("Capture started successfully")
+                    logger.info("Capture started successfully")
 
             self.stream.startCaptureWithCompletionHandler_(start_handler)
 
-            print(f"Capturing to {output_url.path()}")
+            logger.info(f"Capturing to {output_url.path()}")
 
         SCK.SCShareableContent.getShareableContentWithCompletionHandler_(handler)
 
@@ -217,127 +464,141 @@ class CaptureManager(NSObject):
         return f"{int(width)}x{int(height)}"
 
     def _make_filter(self, display):
-        if hasattr(SCK.SCContentFilter, "filterWithDisplay_excludingWindows_exceptingApplications_"):
-            return SCK.SCContentFilter.filterWithDisplay_excludingWindows_exceptingApplications_(
-                display, [], []
-            )
-        if hasattr(SCK.SCContentFilter, "filterWithDisplay_excludingWindows_"):
-            return SCK.SCContentFilter.filterWithDisplay_excludingWindows_(display, [])
-
-        instance = SCK.SCContentFilter.alloc()
-        if hasattr(instance, "initWithDisplay_excludingWindows_exceptingApplications_"):
-            return instance.initWithDisplay_excludingWindows_exceptingApplications_(
-                display, [], []
-            )
-        if hasattr(instance, "initWithDisplay_excludingWindows_"):
-            return instance.initWithDisplay_excludingWindows_(display, [])
-        return None
+        return _FILTER_FACTORY(display)
 
     def stopCapture(self):
         if self.stream is None:
             return
 
-        # Mark inputs as finished immediately to stop accepting new data
-        if self.video_input is not None:
-            self.video_input.markAsFinished()
-        if self.audio_input is not None:
-            self.audio_input.markAsFinished()
-
-        # Prevent multiple stream stop calls
+        # Prevent multiple stream stop calls; the first one drives the whole shutdown
         if self.is_stopping:
-            # Already stopping, just schedule finish writing immediately
-            dispatch_after(
-                dispatch_time(DISPATCH_TIME_NOW, 100_000_000),  # 0.1 seconds
-                dispatch_get_main_queue(),
-                self._finish_writing
-            )
             return
 
         self.is_stopping = True
+        group = self._shutdown_group
+        dispatch_group_enter(group)
 
         def stop_handler(error):
             # Ignore stream stop errors (stream may already be stopping)
             if error is not None and "already" not in str(error):
-                print(f"Error stopping capture: {error}")
+                logger.error(f"Error stopping capture: {error}")
 
-            # Delay briefly to allow pending data to be processed, then finish writing
-            dispatch_after(
-                dispatch_time(DISPATCH_TIME_NOW, 200_000_000),  # 0.2 seconds
-                dispatch_get_main_queue(),
-                self._finish_writing
-            )
+            # No more samples arrive now; finish the inputs behind any pending appends
+            self._finish_inputs()
+            dispatch_group_leave(group)
 
         self.stream.stopCaptureWithCompletionHandler_(stop_handler)
+        dispatch_group_notify(group, _MAIN_Q, self._finish_writing)
+
+    def _finish_inputs(self):
+        """Drain and finish each input on its write queue, tracked by the shutdown group"""
+        group = self._shutdown_group
+
+        deadline = time.monotonic() + _FINISH_DRAIN_TIMEOUT
+
+        def finish(writer_input, ring, drain, queue):
+            # Keep appending until the ring is empty or time runs out, then close the input
+            drain()
+            if ring and time.monotonic() < deadline:
+                dispatch_after(
+                    dispatch_time(DISPATCH_TIME_NOW, _DRAIN_RETRY_NS),
+                    queue,
+                    lambda: finish(writer_input, ring, drain, queue)
+                )
+                return
+            writer_input.markAsFinished()
+            # Whatever is left can no longer be written; release it (and its surfaces)
+            ring.clear()
+            dispatch_group_leave(group)
+
+        if self.video_input is not None:
+            dispatch_group_enter(group)
+            dispatch_async(self.video_write_queue, lambda: finish(
+                self.video_input, self._video_frame_ring, self._drain_video, self.video_write_queue
+            ))
+        if self.audio_input is not None:
+            dispatch_group_enter(group)
+            dispatch_async(self.audio_write_queue, lambda: finish(
+                self.audio_input, self._audio_sample_ring, self._drain_audio, self.audio_write_queue
+            ))
 
     def _finish_writing(self):
         """Finish writing the video file after stream is stopped"""
         if self.writer is None:
             return
+        self.is_finishing = True
 
         # Check writer status: 0=unknown, 1=writing, 2=finished, 3=failed, 4=cancelled
         status = self.writer.status()
         if status != 1:  # Only finish if currently writing
             reason_text = "time limit reached" if self.stop_reason == "time" else "user interrupted"
-            print(f"Capture saved successfully (stopped by: {reason_text})")
-            NSApp.terminate_(None)
+            logger.info(f"Capture saved successfully (stopped by: {reason_text})")
+            terminate()
             return
 
-        try:
-            def finish_handler():
-                reason_text = "time limit reached" if self.stop_reason == "time" else "user interrupted"
-                print(f"Capture saved successfully (stopped by: {reason_text})")
-                # Schedule app termination on main queue after a short delay
-                dispatch_after(
-                    dispatch_time(DISPATCH_TIME_NOW, 500_000_000),  # 0.5 seconds
-                    dispatch_get_main_queue(),
-                    lambda: NSApp.terminate_(None)
-                )
+        group = self._shutdown_group
+        dispatch_group_enter(group)
+
+        def finish_handler():
+            reason_text = "time limit reached" if self.stop_reason == "time" else "user interrupted"
+            logger.info(f"Capture saved successfully (stopped by: {reason_text})")
+            dispatch_group_leave(group)
 
+        try:
             self.writer.finishWritingWithCompletionHandler_(finish_handler)
         except Exception as e:
-            print(f"Error finishing writing: {e}")
-            NSApp.terminate_(None)
+            logger.error(f"Error finishing writing: {e}")
+            dispatch_group_leave(group)
+
+        # Terminate as soon as the file is finalized
+        dispatch_group_notify(group, _MAIN_Q, terminate)
 
     def _make_output_url(self):
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        file_name = f"Capture-{timestamp}.mov"
-        project_dir = pathlib.Path(__file__).parent.parent
-        captured_videos_dir = project_dir / "captured_videos"
-        captured_videos_dir.mkdir(parents=True, exist_ok=True)
-        return NSURL.fileURLWithPath_(str(captured_videos_dir / file_name))
+        timestamp = time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())
+        # No F_PREALLOCATE here: AVAssetWriter fails if the output file already
+        # exists, so the file cannot be created and reserved ahead of the writer.
+        return NSURL.fileURLWithPath_(f"{_CAPTURE_DIR}/Capture-{timestamp}.mov")
 
     def _setup_writer(self, output_url, configuration):
         writer, error = AVAssetWriter.alloc().initWithURL_fileType_error_(
             output_url, "com.apple.quicktime-movie", None
         )
         if writer is None:
-            print(f"Failed to create writer: {error}")
+            logger.error(f"Failed to create writer: {error}")
             return False
 
+        width = configuration.width()
+        height = configuration.height()
         video_settings = {
-            AVVideoCodecKey: AVVideoCodecTypeH264,
-            AVVideoWidthKey: configuration.width(),
-            AVVideoHeightKey: configuration.height(),
+            **_BASE_VIDEO_SETTINGS,
+            AVVideoWidthKey: width,
+            AVVideoHeightKey: height,
+            AVVideoCompressionPropertiesKey: {
+                **_BASE_COMPRESSION_PROPERTIES,
+                # ~4 bits per pixel per second: ~8.3 Mbps at 1080p, scales with capture size
+                AVVideoAverageBitRateKey: width * height * 4,
+            },
         }
         video_input = AVAssetWriterInput.alloc().initWithMediaType_outputSettings_(
             AVMediaTypeVideo, video_settings
         )
         video_input.setExpectsMediaDataInRealTime_(True)
+        # Real-time capture: single pass, never hold frames for a second encode pass
+        video_input.setPerformsMultiPassEncodingIfSupported_(False)
 
         adaptor = AVAssetWriterInputPixelBufferAdaptor.alloc().initWithAssetWriterInput_sourcePixelBufferAttributes_(
             video_input,
             {
-                CoreVideo.kCVPixelBufferPixelFormatTypeKey: CoreVideo.kCVPixelFormatType_32BGRA,
-                CoreVideo.kCVPixelBufferWidthKey: configuration.width(),
-                CoreVideo.kCVPixelBufferHeightKey: configuration.height(),
+                **_BASE_ADAPTOR_ATTRS,
+                CoreVideo.kCVPixelBufferWidthKey: width,
+                CoreVideo.kCVPixelBufferHeightKey: height,
             },
         )
 
         audio_settings = {
-            AVFormatIDKey: 0x61616320,
+            **_BASE_AUDIO_SETTINGS,
             AVSampleRateKey: configuration.sampleRate(),
             AVNumberOfChannelsKey: configuration.channelCount(),
-            AVEncoderBitRateKey: 256_000,
         }
         audio_input = AVAssetWriterInput.alloc().initWithMediaType_outputSettings_(
             AVMediaTypeAudio, audio_settings
@@ -349,98 +610,186 @@ class CaptureManager(NSObject):
         if writer.canAddInput_(audio_input):
             writer.addInput_(audio_input)
 
+        # Leave shouldOptimizeForNetworkUse off: moving the moov atom to the front
+        # rewrites the whole file in finishWriting, which hurts long local captures.
         self.writer = writer
         self.video_input = video_input
         self.audio_input = audio_input
         self.pixel_adaptor = adaptor
+        self._append_pb = adaptor.appendPixelBuffer_withPresentationTime_
+        self._ready_v = video_input.isReadyForMoreMediaData
+        self._append_audio = audio_input.appendSampleBuffer_
+        self._ready_a = audio_input.isReadyForMoreMediaData
+
+        video_ring = self._video_frame_ring
+        audio_ring = self._audio_sample_ring
+        ready_v = self._ready_v
+        append_pb = self._append_pb
+        ready_a = self._ready_a
+        append_audio = self._append_audio
+
+        def retrying(drain_ring, ring, queue):
+            """Wrap drain_ring so leftovers get their own wake-up on queue"""
+            retry_pending = [False]  # Only touched on queue
+
+            def retry():
+                retry_pending[0] = False
+                drain()
+
+            def drain():
+                drain_ring()
+                if ring and not retry_pending[0]:
+                    retry_pending[0] = True
+                    dispatch_after(dispatch_time(DISPATCH_TIME_NOW, _DRAIN_RETRY_NS), queue, retry)
+
+            return drain
+
+        def drain_video_ring():
+            with objc.autorelease_pool():
+                while video_ring and ready_v():
+                    pixel_buffer, pts = video_ring.popleft()
+                    append_pb(pixel_buffer, pts)
+
+        def drain_audio_ring():
+            with objc.autorelease_pool():
+                while audio_ring and ready_a():
+                    append_audio(audio_ring.popleft())
+
+        # Drains are scheduled by the sample callback after it queues new data,
+        # and re-run themselves while the input is not ready. No
+        # requestMediaDataWhenReadyOnQueue_ pull block: it would keep firing with
+        # an empty ring while the input stays ready.
+        drain_video = retrying(drain_video_ring, video_ring, self.video_write_queue)
+        drain_audio = retrying(drain_audio_ring, audio_ring, self.audio_write_queue)
+        self._drain_video = drain_video
+        self._drain_audio = drain_audio
+        # Audio frames queued since the writer was last woken, only touched on audio_queue.
+        # A plain list cell, so the count never goes through NSObject attribute access.
+        audio_pending = [0]
+        audio_batch_frames = int(configuration.sampleRate()) // 10
+        self._fast = (
+            (video_ring, drain_video, self.video_write_queue),
+            (audio_ring, drain_audio, self.audio_write_queue, audio_batch_frames, audio_pending),
+        )
         return True
 
     def stream_didOutputSampleBuffer_ofType_(self, stream, sample_buffer, output_type):
-        if not CoreMedia.CMSampleBufferDataIsReady(sample_buffer):
+        # Hot path: runs for every screen and audio sample. Check Python-side
+        # state before crossing the bridge, and call the CoreMedia functions
+        # through module globals rather than attribute lookups on the module.
+        # Drain autoreleased bridge objects per sample rather than whenever the
+        # dispatch queue's pool happens to drain, so capture surfaces go back sooner
+        with objc.autorelease_pool():
+            fast = self._fast
+            if fast is None:
+                return
+            if not CMSampleBufferDataIsReady(sample_buffer):
+                return
+            video_fast, audio_fast = fast
+
+            # CMTime comes back by value through the bridge; read it at most once per sample
+            pts = None
+            if self.session_start_time is None:
+                with self._session_lock:
+                    if self.session_start_time is None:
+                        pts = CMSampleBufferGetPresentationTimeStamp(sample_buffer)
+                        self.writer.startWriting()
+                        self.writer.startSessionAtSourceTime_(pts)
+                        # Publish only once the session has started so the other queue can append
+                        self.session_start_time = pts
+
+            if output_type == _OUTPUT_TYPE_SCREEN:
+                # Only complete frames carry new pixels; idle/blank ones repeat the last frame
+                attachments = CMSampleBufferGetSampleAttachmentsArray(sample_buffer, False)
+                if not attachments or attachments[0].get(_FRAME_INFO_STATUS) != _FRAME_STATUS_COMPLETE:
+                    return
+                pixel_buffer = CMSampleBufferGetImageBuffer(sample_buffer)
+                if pixel_buffer is None:
+                    return
+                if pts is None:
+                    pts = CMSampleBufferGetPresentationTimeStamp(sample_buffer)
+                video_ring, drain_video, video_write_queue = video_fast
+                now = time.monotonic()
+                if len(video_ring) == _VIDEO_RING_FRAMES:
+                    # The writer has not drained the ring; the append below evicts the oldest frame
+                    self._note_video_backpressure(now)
+                else:
+                    self._note_video_ready(now)
+                video_ring.append((pixel_buffer, pts))
+                dispatch_async(video_write_queue, drain_video)
+            elif output_type == _OUTPUT_TYPE_AUDIO:
+                # Amortize the queue hop: wake the audio writer ~every 100 ms of samples
+                audio_ring, drain_audio, audio_write_queue, batch_frames, pending = audio_fast
+                audio_ring.append(sample_buffer)
+                pending[0] += CMSampleBufferGetNumSamples(sample_buffer)
+                if pending[0] >= batch_frames:
+                    pending[0] = 0
+                    dispatch_async(audio_write_queue, drain_audio)
+
+    def _note_video_backpressure(self, now):
+        """Count a frame dropped from the full ring and throttle capture if the encoder stays behind"""
+        self._drops += 1
+        self._ready_streak = 0
+        if self._throttled or self._last_ready_time is None:
             return
-        if self.writer is None:
+        if self._drops >= _BACKPRESSURE_DROPS and now - self._last_ready_time > _BACKPRESSURE_WINDOW:
+            logger.info(f"Encoder falling behind, lowering capture rate to {_THROTTLED_FRAME_RATE} fps")
+            self._set_frame_interval(_THROTTLED_FRAME_INTERVAL, throttled=True)
+
+    def _note_video_ready(self, now):
+        """Record a frame queued without eviction and restore full rate once the encoder keeps up"""
+        self._last_ready_time = now
+        self._drops = 0
+        if not self._throttled:
+            return
+        self._ready_streak += 1
+        if self._ready_streak >= _BACKPRESSURE_RECOVERY_FRAMES:
+            logger.info(f"Encoder caught up, restoring capture rate to {_FRAME_RATE} fps")
+            self._set_frame_interval(_FRAME_INTERVAL, throttled=False)
+
+    def _set_frame_interval(self, interval, throttled):
+        """Apply a new minimum frame interval to the running stream"""
+        self._throttled = throttled
+        self._ready_streak = 0
+        if self.is_stopping or self.stream is None:
             return
 
-        if self.session_start_time is None:
-            self.session_start_time = CoreMedia.CMSampleBufferGetPresentationTimeStamp(
-                sample_buffer
-            )
-            self.writer.startWriting()
-            self.writer.startSessionAtSourceTime_(self.session_start_time)
+        def update_handler(error):
+            if error is not None:
+                logger.error(f"Failed to update frame interval: {error}")
 
-        if output_type == SCK.SCStreamOutputTypeScreen:
-            if self.video_input is None or not self.video_input.isReadyForMoreMediaData():
-                return
-            pixel_buffer = CoreMedia.CMSampleBufferGetImageBuffer(sample_buffer)
-            if pixel_buffer is None:
-                return
-            time = CoreMedia.CMSampleBufferGetPresentationTimeStamp(sample_buffer)
-            self.pixel_adaptor.appendPixelBuffer_withPresentationTime_(pixel_buffer, time)
-        elif output_type == SCK.SCStreamOutputTypeAudio:
-            if self.audio_input is None or not self.audio_input.isReadyForMoreMediaData():
-                return
-            self.audio_input.appendSampleBuffer_(sample_buffer)
+        self.configuration.setMinimumFrameInterval_(interval)
+        self.stream.updateConfiguration_completionHandler_(self.configuration, update_handler)
 
     def stream_didStopWithError_(self, stream, error):
-        print(f"Stream stopped: {error}")
-
-
-class CaptureAppDelegate(NSObject):
-    def applicationDidFinishLaunching_(self, notification):
-        self.manager = CaptureManager.alloc().init()
-        self.manager.selected_display_index = self.display_index
-        self.manager.startCapture()
-
-        # Schedule stopCapture to run after specified duration
-        def stop_callback():
-            # Only set stop_reason to "time" if not already stopped by interrupt
-            if not self.manager.is_stopping:
-                self.manager.stop_reason = "time"
-            self.manager.stopCapture()
-
-        duration_ns = int(self.duration_seconds * 1_000_000_000)
-        dispatch_after(
-            dispatch_time(DISPATCH_TIME_NOW, duration_ns),
-            dispatch_get_main_queue(),
-            stop_callback
-        )
+        logger.error(f"Stream stopped: {error}")
 
 
 def list_displays():
     """List all available displays"""
     def handler(content, error):
         if error is not None:
-            sys.stderr.write(f"Failed to get shareable content: {error}\n")
-            sys.stderr.flush()
+            _emit(f"Failed to get shareable content: {error}\n", fd=2)
         else:
             displays = content.displays()
             if not displays:
-                sys.stdout.write("No displays available\n")
-                sys.stdout.flush()
+                _emit("No displays available\n")
             else:
-                sys.stdout.write("Available displays:\n")
-                sys.stdout.flush()
-                for i, display in enumerate(displays):
-                    frame = display.frame()
-                    width = int(frame.size.width)
-                    height = int(frame.size.height)
-                    origin_x = int(frame.origin.x)
-                    origin_y = int(frame.origin.y)
-                    sys.stdout.write(f"  Display {i}: {width}x{height} at position ({origin_x}, {origin_y})\n")
-                    sys.stdout.flush()
-
-        # Exit the event loop after handler completes
-        def exit_app():
-            NSApp.terminate_(None)
-        dispatch_after(
-            dispatch_time(DISPATCH_TIME_NOW, 100_000_000),  # 0.1 seconds
-            dispatch_get_main_queue(),
-            exit_app
-        )
+                # Format every entry first, then emit the listing with a single write(2)
+                frames = [display.frame() for display in displays]
+                out = ["Available displays:\n"]
+                out.extend(
+                    f"  Display {i}: {int(frame.size.width)}x{int(frame.size.height)} "
+                    f"at position ({int(frame.origin.x)}, {int(frame.origin.y)})\n"
+                    for i, frame in enumerate(frames)
+                )
+                _emit("".join(out))
+
+        # Output is already written synchronously; exit the run loop right away
+        terminate()
 
-    app = NSApplication.sharedApplication()
     SCK.SCShareableContent.getShareableContentWithCompletionHandler_(handler)
-    app.run()
+    CFRunLoopRun()
 
 
 def main():
@@ -472,6 +821,10 @@ def main():
     )
     args = parser.parse_args()
 
+    # Without NSApplication nothing connects to the window server before
+    # ScreenCaptureKit needs it; CGMainDisplayID() does so cheaply
+    CoreVideo.CGMainDisplayID()
+
     # Handle --list-displays
     if args.list_displays:
         list_displays()
@@ -485,42 +838,64 @@ def main():
         print("Error: Display index must be >= 0")
         return
 
+    setup_logging()
+
     # Set up signal handler for Ctrl+C
     signal.signal(signal.SIGINT, handle_sigint)
 
-    # Start keyboard monitor thread to catch Ctrl+C
-    monitor_thread = threading.Thread(target=keyboard_monitor, daemon=True)
-    monitor_thread.start()
-
-    app = NSApplication.sharedApplication()
-    delegate = CaptureAppDelegate.alloc().init()
-    delegate.duration_seconds = args.time
-    delegate.display_index = args.display
+    # Watch stdin for ESC from the main run loop
+    install_keyboard_monitor()
 
-    global _global_delegate
-    _global_delegate = delegate
+    manager = CaptureManager.alloc().init()
+    manager.selected_display_index = args.display
 
-    app.setDelegate_(delegate)
+    global _global_manager
+    _global_manager = manager
 
     # If simulate-interrupt is set, automatically trigger interrupt after specified time
     if args.simulate_interrupt is not None:
         print(f"Recording will stop after {args.time} seconds, or simulate interrupt after {args.simulate_interrupt} seconds")
 
         def simulate_interrupt():
-            sys.stdout.write(f"\n[SIMULATED INTERRUPT at {args.simulate_interrupt}s]\n")
-            sys.stdout.flush()
+            _emit(f"\n[SIMULATED INTERRUPT at {args.simulate_interrupt}s]\n")
             handle_sigint(signal.SIGINT, None)
 
         interrupt_ns = int(args.simulate_interrupt * 1_000_000_000)
         dispatch_after(
             dispatch_time(DISPATCH_TIME_NOW, interrupt_ns),
-            dispatch_get_main_queue(),
+            _MAIN_Q,
             simulate_interrupt
         )
     else:
         print(f"Recording will stop after {args.time} seconds, or press ESC to stop early")
 
-    app.run()
+    manager.startCapture()
+
+    # Schedule stopCapture to run after specified duration
+    def stop_callback():
+        # Only set stop_reason to "time" if not already stopped by interrupt
+        if not manager.is_stopping:
+            manager.stop_reason = "time"
+        manager.stopCapture()
+
+    duration_ns = int(args.time * 1_000_000_000)
+    dispatch_after(
+        dispatch_time(DISPATCH_TIME_NOW, duration_ns),
+        _MAIN_Q,
+        stop_callback
+    )
+
+    # Service the main dispatch queue and the stdin source until terminate()
+    try:
+        CFRunLoopRun()
+    finally:
+        restore_terminal()
+        shutdown_logging()
+
+    # The movie is finalized and the logs are flushed. Skip interpreter teardown,
+    # which could race late sample callbacks still running on the capture queues.
+    sys.stdout.flush()
+    os._exit(0)
 
 
 if __name__ == "__main__":